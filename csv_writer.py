@@ -1,12 +1,114 @@
+import csv
 import json
 import logging
+import multiprocessing
+import orjson
+import os
+from collections import deque
+from itertools import compress
 from twarc.decorators2 import FileSizeProgressBar
-from more_itertools import ichunked
+from more_itertools import chunked, ichunked
+import pandas as pd
 
 import dataframe_converter
 
 log = logging.getLogger("twarc")
 
+# Size of each read from the input file, in bytes (or characters for text files)
+READ_CHUNK_SIZE = 1 << 20
+
+# Batch sizes when batch_size is not set: pipes use a small fixed batch size, and for files
+# each batch covers up to 2MB of input (about 1,000 tweets). Larger batches are not faster,
+# but use much more memory.
+DEFAULT_BATCH_SIZE = 100
+MAX_BATCH_BYTES = 1000 * 2048
+
+# DataFrameConverter used by each worker process, see _init_worker
+_worker_converter = None
+
+
+def _csv_writer(outfile):
+    """
+    CSV writer with the output format, used for the output file and in workers.
+    """
+    return csv.writer(outfile, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+
+
+def _output_rows(converter, _df):
+    """
+    Values of the output columns as lists, one per row.
+    Missing values are written as empty fields, same as pandas to_csv.
+    """
+    values = _df[converter.output_columns].to_numpy(dtype=object)
+    values[pd.isna(values)] = None
+    return values.tolist()
+
+
+class _Lines(list):
+    """
+    List of CSV lines, used as a file by csv.writer, which writes each row with one call.
+    """
+
+    write = list.append
+
+
+def parse_lines(lines, counts):
+    """
+    Generator for parsing a list of lines, skipping blank lines and counting errors.
+    """
+    for line in lines:
+        if line.strip():
+            try:
+                try:
+                    o = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # json is less strict, eg: NaN and Infinity, as written by json.dumps
+                    o = json.loads(line)
+                yield o
+            except Exception as ex:
+                counts["parse_errors"] += 1
+                if isinstance(line, bytes):
+                    line = line.decode("utf8", errors="replace")
+                log.error(f"Error when trying to parse json: '{line}' {ex}")
+
+
+def _init_worker(converter):
+    """
+    Set up a worker process with its own copy of the converter.
+    Duplicates are dropped in the main process, where all the ids are known.
+    """
+    global _worker_converter
+    _worker_converter = converter
+    _worker_converter.allow_duplicates = True
+
+
+def _process_batch(batch):
+    """
+    Parse and convert a batch of lines in a worker process.
+    Returns the rows as CSV lines, the ids of the rows, the flattened keys of each row
+    if any of them are unexpected, and the changes to counts. The column check is left to the main
+    process, which has to remove duplicates first.
+    """
+    converter = _worker_converter
+    counts = dict(converter.counts)
+    tweets = list(converter._transform(parse_lines(batch, converter.counts)))
+    ids = (
+        None
+        if converter.input_data_type == "counts"
+        else [dataframe_converter.id_key(t["id"]) for t in tweets]
+    )
+    row_keys = None
+    if any(converter._has_unexpected(tweet) for tweet in tweets):
+        row_keys = [set(converter._flat_keys(tweet)) for tweet in tweets]
+    _df = converter._records_dataframe(tweets)
+    converter.dataset_ids.clear()
+    counts = {k: converter.counts[k] - v for k, v in counts.items()}
+    lines = _Lines()
+    _csv_writer(lines).writerows(
+        _output_rows(converter, converter._process_dataframe(_df))
+    )
+    return lines, ids, row_keys, counts
+
 
 class CSVConverter:
     """
@@ -19,68 +121,179 @@ class CSVConverter:
         outfile,
         converter=dataframe_converter.DataFrameConverter(),
         output_format="csv",
-        batch_size=100,
+        batch_size=None,
         hide_progress=False,
+        jobs=1,
     ):
         self.infile = infile
         self.outfile = outfile
         self.converter = converter
         self.output_format = output_format
-        self.batch_size = batch_size
         self.hide_progress = hide_progress
+        self.jobs = jobs
+        self.batch_size = batch_size if batch_size else self._auto_batch_size()
+        # A single writer is reused for every batch, the header is written once
+        self.writer = _csv_writer(outfile)
         self.progress = FileSizeProgressBar(
             infile, outfile, disable=(hide_progress or not self.infile.seekable())
         )
 
-    def _read_lines(self):
+    def _auto_batch_size(self):
         """
-        Generator for reading files line by line from a file. Progress bar is based on file size.
+        Pick a batch size (in lines) for the input file, so small files are still split between jobs.
+        Lines can be single tweets or whole API responses, so the average line size is
+        estimated from the start of the file.
         """
-        line = self.infile.readline()
-        while line:
+        if not self.infile.seekable():
+            return DEFAULT_BATCH_SIZE
+        try:
+            # The file name is used for the size, the same way as for the progress bar:
+            file_size = os.stat(self.infile.name).st_size
+        except (AttributeError, TypeError, OSError):
+            return DEFAULT_BATCH_SIZE
+        batch_bytes = min(MAX_BATCH_BYTES, file_size // max(1, self.jobs))
+        position = self.infile.tell()
+        sample = self.infile.read(READ_CHUNK_SIZE)
+        self.infile.seek(position)
+        newlines = sample.count(b"\n" if isinstance(sample, bytes) else "\n")
+        line_size = max(1, len(sample) // max(1, newlines))
+        return max(1, batch_bytes // line_size)
+
+    def _read_chunks(self):
+        """
+        Generator for reading a file in large chunks, as lists of lines. Progress bar is based on file size.
+        This avoids calling readline() per line. Lines can be bytes (preferred, if the file is opened
+        in binary mode) or str.
+        """
+        # read1() returns as soon as some data is available, so pipes are not held up:
+        read = getattr(self.infile, "read1", self.infile.read)
+        update_progress = not self.hide_progress and self.infile.seekable()
+        # Pieces of a line that continues into the next chunk:
+        partial = []
+        chunk = read(READ_CHUNK_SIZE)
+        while chunk:
+            if update_progress:
+                self.progress.update(len(chunk))
+            lines = chunk.split(b"\n" if isinstance(chunk, bytes) else "\n")
+            if len(lines) > 1:
+                lines[0] = chunk[:0].join(partial + [lines[0]])
+                partial = []
+                self.converter.counts["lines"] += len(lines) - 1
+                yield lines[:-1]
+            partial.append(lines[-1])
+            chunk = read(READ_CHUNK_SIZE)
+        remainder = chunk[:0].join(partial)
+        if remainder:
             self.converter.counts["lines"] += 1
-            if line.strip() != "":
-                try:
-                    o = json.loads(line)
-                    yield o
-                except Exception as ex:
-                    self.converter.counts["parse_errors"] += 1
-                    log.error(f"Error when trying to parse json: '{line}' {ex}")
-            if not self.hide_progress and self.infile.seekable():
-                self.progress.update(self.infile.tell() - self.progress.n)
-            line = self.infile.readline()
+            yield [remainder]
 
-    def _write_output(self, _df, first_batch):
+    def _read_lines(self):
+        """
+        Generator for parsed lines from a file.
         """
-        Write out the dataframe chunk by chunk
+        for lines in self._read_chunks():
+            yield from parse_lines(lines, self.converter.counts)
 
-        todo: take parameters from commandline for optional output formats.
+    def _write_output(self, _df, first_batch):
+        """
+        Write out the dataframe chunk by chunk, as rows of the selected output columns.
         """
         if first_batch:
-            mode = "w"
-            header = True
-        else:
-            mode = "a+"
-            header = False
+            self.writer.writerow(self.converter.output_columns)
 
         self.converter.counts["rows"] += len(_df)
-        _df.to_csv(
-            self.outfile,
-            mode=mode,
-            columns=self.converter.output_columns,
-            index=False,
-            header=header,
-        )  # todo: (Optional) arguments for to_csv
+        self.writer.writerows(_output_rows(self.converter, _df))
+
+    def _write_lines(self, lines, first_batch):
+        """
+        Write out CSV lines already formatted by a worker.
+        """
+        if first_batch:
+            self.writer.writerow(self.converter.output_columns)
+
+        self.converter.counts["rows"] += len(lines)
+        self.outfile.write("".join(lines))
+
+    def _keep_rows(self, ids):
+        """
+        Find the rows to keep from a batch returned by a worker, and count duplicates.
+        """
+        counts = self.converter.counts
+        dataset_ids = self.converter.dataset_ids
+        keep = []
+        for tweet_id in ids:
+            if tweet_id in dataset_ids:
+                counts["duplicates"] += 1
+                keep.append(self.converter.allow_duplicates)
+            else:
+                keep.append(True)
+                dataset_ids.add(tweet_id)
+        return keep
+
+    def _process_serial(self):
+        """
+        Generator for converting batches one at a time.
+        """
+        # Lines are parsed as the batch is consumed, so the parsed objects
+        # of a whole batch are not all kept in memory at once
+        for batch in ichunked(self._read_lines(), self.batch_size):
+            yield self.converter.process(batch)
+
+    def _process_parallel(self):
+        """
+        Generator for converting batches in a pool of worker processes, in the original order.
+        Only a few batches are queued at a time, to keep memory use bounded.
+        """
+        with multiprocessing.Pool(
+            self.jobs, initializer=_init_worker, initargs=(self.converter,)
+        ) as pool:
+            pending = deque()
+            # Workers parse the lines too. Blank lines are skipped here, so batches
+            # are the same as in serial mode, unless some lines fail to parse
+            lines = (
+                line for lines in self._read_chunks() for line in lines if line.strip()
+            )
+            for batch in chunked(lines, self.batch_size):
+                pending.append(pool.apply_async(_process_batch, (batch,)))
+                while len(pending) >= 2 * self.jobs or (pending and pending[0].ready()):
+                    yield self._collect(pending.popleft().get())
+            while pending:
+                yield self._collect(pending.popleft().get())
+
+    def _collect(self, result):
+        """
+        Merge the result of a worker into the converter counts, deduplicate it and check its columns.
+        """
+        lines, ids, row_keys, counts = result
+        for k, v in counts.items():
+            if k != "duplicates":
+                self.converter.counts[k] += v
+        # Counts have no ids, and are never duplicates
+        keep = [True] * len(lines) if ids is None else self._keep_rows(ids)
+        if row_keys is not None:
+            # Only the rows left after removing duplicates are checked, as in serial mode
+            keys = set()
+            for kept, k in zip(keep, row_keys):
+                if kept:
+                    keys.update(k)
+            if not self.converter._check_columns(keys, sum(keep)):
+                return []
+        return list(compress(lines, keep))
 
     def process(self):
         """
         Process a file containing JSON into a CSV
         """
 
+        batches = self._process_parallel() if self.jobs > 1 else self._process_serial()
+
+        # Workers send back formatted lines, serial batches are dataframes
+        write = self._write_lines if self.jobs > 1 else self._write_output
+
         # Flag for writing header & appending to CSV file
         first_batch = True
-        for batch in ichunked(self._read_lines(), self.batch_size):
-            self._write_output(self.converter.process(batch), first_batch)
+        for batch in batches:
+            write(batch, first_batch)
             first_batch = False
 
         self.progress.close()
@@ -1,15 +1,143 @@
 import json
-import copy
 import click
-import itertools
-from collections import ChainMap
 import logging
+import orjson
 
 import pandas as pd
 from twarc import ensure_flattened
 
 log = logging.getLogger("twarc")
 
+
+def json_dumps(obj):
+    """
+    Serialize with orjson, or json for anything orjson can't handle (eg: very large ints).
+    """
+    try:
+        return orjson.dumps(obj).decode()
+    except TypeError:
+        return json.dumps(obj)
+
+
+def escape_newlines(text):
+    """
+    Mandatory newline escape to prevent breaking csv format.
+    """
+    return text.replace("\r", "").replace("\n", r"\n")
+
+
+def id_key(object_id):
+    """
+    Key for an object id in dataset_ids. Numeric ids are stored as ints, which take less memory than strings
+    (about 35MB instead of 48MB for 500,000 ids).
+    """
+    if type(object_id) is str and object_id.isascii() and object_id.isdigit():
+        return int(object_id)
+    return object_id
+
+
+def map_values(values, func):
+    """
+    Apply a function that returns scalars (eg: strings) to the non missing values of a column.
+    Works on the numpy array, which is faster than Series.map for short columns.
+    """
+    values = values.to_numpy(dtype=object)
+    mask = pd.notna(values)
+    result = values.copy()
+    result[mask] = [func(x) for x in values[mask]]
+    return result
+
+
+def flatten_response(response):
+    """
+    Flatten an API response with data and includes, the same way as twarc's flatten:
+    included users, media, polls, places and tweets are moved inline where they are referenced.
+    Only dicts and lists are walked, and they are expanded in place, which is much faster than
+    visiting every value. Missing includes are expanded to empty objects.
+    """
+    includes = response["includes"]
+
+    def extract(expansion, key="id"):
+        return {include[key]: include for include in includes.get(expansion, ())}
+
+    # Users by id and by username, for expanding mentions
+    users = {**extract("users", "id"), **extract("users", "username")}
+    media = extract("media", "media_key")
+    polls = extract("polls")
+    places = extract("places")
+    tweets = extract("tweets")
+
+    def expand_list(payload):
+        for item in payload:
+            if type(item) is dict:
+                expand(item)
+            elif type(item) is list:
+                expand_list(item)
+
+    def expand(payload):
+        for value in payload.values():
+            if type(value) is dict:
+                expand(value)
+            elif type(value) is list:
+                expand_list(value)
+
+        if "author_id" in payload:
+            payload["author"] = users.get(payload["author_id"], {})
+
+        if "in_reply_to_user_id" in payload:
+            payload["in_reply_to_user"] = users.get(payload["in_reply_to_user_id"], {})
+
+        if "media_keys" in payload:
+            payload["media"] = [media.get(key, {}) for key in payload["media_keys"]]
+
+        if "poll_ids" in payload and len(payload["poll_ids"]) > 0:
+            # only ever 1 poll per tweet
+            payload["poll"] = polls.get(payload["poll_ids"][-1], {})
+
+        if "geo" in payload and "place_id" in payload["geo"]:
+            place_id = payload["geo"]["place_id"]
+            payload["geo"] = {**payload["geo"], **places.get(place_id, {})}
+
+        if "mentions" in payload:
+            payload["mentions"] = [
+                {**user, **users.get(user["username"], {})}
+                for user in payload["mentions"]
+            ]
+
+        if "referenced_tweets" in payload:
+            payload["referenced_tweets"] = [
+                {**referenced_tweet, **tweets.get(referenced_tweet["id"], {})}
+                for referenced_tweet in payload["referenced_tweets"]
+            ]
+
+        if "pinned_tweet_id" in payload:
+            payload["pinned_tweet"] = tweets.get(payload["pinned_tweet_id"], {})
+
+    # Included tweets are expanded first, so referenced tweets are complete:
+    for included_tweet in tweets.values():
+        expand(included_tweet)
+
+    data = response["data"]
+    if isinstance(data, list):
+        expand_list(data)
+        data = list(data)
+    elif isinstance(data, dict):
+        expand(data)
+        data = [data]
+    else:
+        data = []
+
+    # Add the __twarc metadata and matching rules to each tweet if it's a result set
+    for key in ("__twarc", "matching_rules"):
+        if key in response:
+            for tweet in data:
+                tweet[key] = response[key]
+    return data
+
+
+# Subtree of keys with no columns, for keys not in the input columns
+_NO_COLUMNS = {}
+
 DEFAULT_TWEET_COLUMNS = """id
 conversation_id
 referenced_tweets.replied_to.id
@@ -97,6 +225,36 @@ __twarc.version""".split(
     "\n"
 )
 
+# Columns that always hold lists in API data, for tweets and users:
+LIST_COLUMNS = {
+    "edit_history_tweet_ids",
+    "withheld.country_codes",
+    "entities.annotations",
+    "entities.cashtags",
+    "entities.hashtags",
+    "entities.mentions",
+    "entities.urls",
+    "context_annotations",
+    "attachments.media",
+    "attachments.media_keys",
+    "attachments.poll.options",
+    "attachments.poll_ids",
+    "author.entities.description.cashtags",
+    "author.entities.description.hashtags",
+    "author.entities.description.mentions",
+    "author.entities.description.urls",
+    "author.entities.url.urls",
+    "author.withheld.country_codes",
+    "geo.coordinates.coordinates",
+    "geo.geo.bbox",
+    "matching_rules",
+    "entities.description.cashtags",
+    "entities.description.hashtags",
+    "entities.description.mentions",
+    "entities.description.urls",
+    "entities.url.urls",
+}
+
 DEFAULT_USER_COLUMNS = """id
 created_at
 username
@@ -198,34 +356,36 @@ class DataFrameConverter:
         self.allow_duplicates = allow_duplicates
         self.input_data_type = input_data_type
         self.columns = list()
+        self._columns_set = set()
         if input_data_type == "tweets":
-            self.columns.extend(
-                x for x in DEFAULT_TWEET_COLUMNS if x not in self.columns
-            )
+            self._add_columns(DEFAULT_TWEET_COLUMNS)
         if input_data_type == "users":
-            self.columns.extend(
-                x for x in DEFAULT_USER_COLUMNS if x not in self.columns
-            )
+            self._add_columns(DEFAULT_USER_COLUMNS)
         if input_data_type == "compliance":
-            self.columns.extend(
-                x for x in DEFAULT_COMPLIANCE_COLUMNS if x not in self.columns
-            )
+            self._add_columns(DEFAULT_COMPLIANCE_COLUMNS)
         if input_data_type == "counts":
-            self.columns.extend(
-                x for x in DEFAULT_COUNTS_COLUMNS if x not in self.columns
-            )
+            self._add_columns(DEFAULT_COUNTS_COLUMNS)
         if input_data_type == "lists":
-            self.columns.extend(
-                x for x in DEFAULT_LISTS_COLUMNS if x not in self.columns
-            )
+            self._add_columns(DEFAULT_LISTS_COLUMNS)
         if extra_input_columns:
-            self.columns.extend(
-                x for x in extra_input_columns.split(",") if x not in self.columns
-            )
+            self._add_columns(extra_input_columns.split(","))
+        # Dotted column names as a tree of keys, for extracting values from nested objects
+        # and checking for unexpected keys. None marks the end of a column name, with its position
+        self._columns_tree = {}
+        for position, column in enumerate(self.columns):
+            node = self._columns_tree
+            for key in column.split("."):
+                node = node.setdefault(key, {})
+            node[None] = position
+        # The same column index is reused for every batch
+        self._columns_index = pd.Index(self.columns)
         self.output_columns = (
             output_columns.split(",") if output_columns else self.columns
         )
-        self.dataset_ids = dataset_ids if dataset_ids else set()
+        # Ids passed in can be strings, they are stored the same way as the ids of the tweets:
+        self.dataset_ids = (
+            {id_key(object_id) for object_id in dataset_ids} if dataset_ids else set()
+        )
         self.counts = (
             counts
             if counts
@@ -246,32 +406,64 @@ class DataFrameConverter:
             }
         )
 
-    def _flatten_objects(self, objects):
+    def _add_columns(self, columns):
         """
-        Generate flattened tweets from a batch of parsed lines.
+        Append columns in order, skipping any that are already present.
         """
-        for o in objects:
-            for item in ensure_flattened(o):
-                yield item
+        for column in columns:
+            if column not in self._columns_set:
+                self._columns_set.add(column)
+                self.columns.append(column)
 
-    def _inline_referenced_tweets(self, tweet):
+    def _flat_keys(self, obj, prefix=""):
         """
-        (Optional) Insert referenced tweets into the main CSV as new rows
+        Generate the dotted column names of an object, the same way pd.json_normalize names them.
+        Nested dicts are expanded, empty dicts produce no columns.
         """
-        if "referenced_tweets" in tweet and self.inline_referenced_tweets:
-            for referenced_tweet in tweet["referenced_tweets"]:
-                # extract the referenced tweet as a new row
-                self.counts["referenced_tweets"] += 1
-                # inherit __twarc metadata from parent tweet
-                referenced_tweet["__twarc"] = (
-                    tweet["__twarc"] if "__twarc" in tweet else None
-                )
-                # write tweet as new row if referenced tweet exists (has more than the 3 default fields):
-                if len(referenced_tweet.keys()) > 3:
-                    yield self._format_tweet(referenced_tweet)
-                else:
-                    self.counts["unavailable"] += 1
-        yield self._format_tweet(tweet)
+        for key, value in obj.items():
+            if isinstance(value, dict):
+                yield from self._flat_keys(value, f"{prefix}{key}.")
+            else:
+                yield f"{prefix}{key}"
+
+    def _has_unexpected(self, obj, node=None):
+        """
+        Check if an object has any keys that would make columns not in the input columns.
+        Cheaper than comparing all the _flat_keys, and stops at the first unexpected key.
+        """
+        if node is None:
+            node = self._columns_tree
+        for key, value in obj.items():
+            child = node.get(key, _NO_COLUMNS)
+            if isinstance(value, dict):
+                if self._has_unexpected(value, child):
+                    return True
+            elif None not in child:
+                return True
+        return False
+
+    def _extract(self, tweet):
+        """
+        Get the values of all input columns from a formatted object, in column order.
+        """
+        row = [None] * len(self.columns)
+        self._fill_row(tweet, self._columns_tree, row)
+        return row
+
+    def _fill_row(self, obj, node, row):
+        """
+        Copy the values of an object into a row, following the tree of column keys.
+        Nested objects are only visited once for all the columns under them.
+        """
+        for key, value in obj.items():
+            child = node.get(key)
+            if child is None:
+                continue
+            position = child.get(None)
+            if position is not None:
+                row[position] = value
+            if isinstance(value, dict):
+                self._fill_row(value, child, row)
 
     def _process_entities(self, entities):
         # Process Entities in the tweet (or user):
@@ -303,8 +495,9 @@ class DataFrameConverter:
         """
         Make the tweet objects easier to deal with, removing extra info and changing the structure.
         """
-        # Make a copy of the original flattened tweet
-        tweet = copy.deepcopy(tweet)
+        # Make a shallow copy of the original flattened tweet. Nested objects can be
+        # shared between tweets (eg: authors), so copy them before modifying them.
+        tweet = dict(tweet)
         # Deal with pinned tweets for user datasets, `tweet` here is actually a user:
         # remove the tweet from a user dataset, pinned_tweet_id remains:
         tweet.pop("pinned_tweet", None)
@@ -312,11 +505,21 @@ class DataFrameConverter:
         tweet.pop("in_reply_to_user", None)
 
         if "referenced_tweets" in tweet:
+            # Find the last reference of each type, and leave behind only the
+            # first id of each type, but not the full tweets, in one pass:
+            reply_tweet = retweeted_tweet = quoted_tweet = None
+            referenced_tweets = {}
+            for r in tweet["referenced_tweets"]:
+                if r["type"] == "replied_to":
+                    reply_tweet = r
+                elif r["type"] == "retweeted":
+                    retweeted_tweet = r
+                elif r["type"] == "quoted":
+                    quoted_tweet = r
+                if r["type"] not in referenced_tweets:
+                    referenced_tweets[r["type"]] = {"id": r["id"]}
+
             # Count Replies:
-            replies = [
-                t for t in tweet["referenced_tweets"] if t["type"] == "replied_to"
-            ]
-            reply_tweet = replies[-1] if replies else None
             if "in_reply_to_user_id" in tweet or reply_tweet:
                 self.counts["replies"] += 1
             if (
@@ -327,8 +530,6 @@ class DataFrameConverter:
                 tweet["in_reply_to_username"] = reply_tweet["author"]["username"]
 
             # Extract Retweet only
-            rts = [t for t in tweet["referenced_tweets"] if t["type"] == "retweeted"]
-            retweeted_tweet = rts[-1] if rts else None
             if retweeted_tweet and "author_id" in retweeted_tweet:
                 self.counts["retweets"] += 1
                 tweet["retweeted_user_id"] = retweeted_tweet["author_id"]
@@ -340,8 +541,6 @@ class DataFrameConverter:
                 tweet["retweeted_username"] = retweeted_tweet["author"]["username"]
 
             # Extract Quoted tweet
-            qts = [t for t in tweet["referenced_tweets"] if t["type"] == "quoted"]
-            quoted_tweet = qts[-1] if qts else None
             if quoted_tweet and "author_id" in quoted_tweet:
                 self.counts["quotes"] += 1
                 tweet["quoted_user_id"] = quoted_tweet["author_id"]
@@ -356,6 +555,7 @@ class DataFrameConverter:
             # If it's a native retweet, replace the "RT @user Text" with the original text, metrics, and entities, but keep the Author.
             if retweeted_tweet and self.merge_retweets:
                 # A retweet inherits everything from retweeted tweet.
+                retweeted_tweet = dict(retweeted_tweet)
                 tweet["text"] = retweeted_tweet.pop("text", tweet.pop("text", None))
                 tweet["entities"] = retweeted_tweet.pop(
                     "entities", tweet.pop("entities", None)
@@ -371,18 +571,13 @@ class DataFrameConverter:
                 )
 
             # reconstruct referenced_tweets object
-            referenced_tweets = [
-                {r["type"]: {"id": r["id"]}} for r in tweet["referenced_tweets"]
-            ]
-            # leave behind references, but not the full tweets
-            # ChainMap flattens list into properties
-            tweet["referenced_tweets"] = dict(ChainMap(*referenced_tweets))
+            tweet["referenced_tweets"] = referenced_tweets
         else:
             tweet["referenced_tweets"] = {}
 
         # Process entities in the tweets:
         if self.process_entities and "entities" in tweet and tweet["entities"]:
-            tweet["entities"] = self._process_entities(tweet["entities"])
+            tweet["entities"] = self._process_entities(dict(tweet["entities"]))
 
         # Process entities in the tweet authors of tweets:
         if (
@@ -391,7 +586,12 @@ class DataFrameConverter:
             and "entities" in tweet["author"]
             and tweet["author"]["entities"]
         ):
+            tweet["author"] = dict(tweet["author"])
+            tweet["author"]["entities"] = dict(tweet["author"]["entities"])
             if "url" in tweet["author"]["entities"]:
+                tweet["author"]["entities"]["url"] = dict(
+                    tweet["author"]["entities"]["url"]
+                )
                 urls = [
                     url["expanded_url"] if "expanded_url" in url else url["url"]
                     for url in tweet["author"]["entities"]["url"].pop("urls", [])
@@ -402,7 +602,7 @@ class DataFrameConverter:
 
             if "description" in tweet["author"]["entities"]:
                 tweet["author"]["entities"]["description"] = self._process_entities(
-                    tweet["author"]["entities"]["description"]
+                    dict(tweet["author"]["entities"]["description"])
                 )
 
         # For older tweet data, make sure the new impressions are missing, not zero:
@@ -411,6 +611,7 @@ class DataFrameConverter:
             and "public_metrics" in tweet
             and "impression_count" not in tweet["public_metrics"]
         ):
+            tweet["public_metrics"] = dict(tweet["public_metrics"])
             tweet["public_metrics"]["impression_count"] = None
 
         # Process entities for users: `tweet` here is a user
@@ -423,11 +624,11 @@ class DataFrameConverter:
             if self.process_entities and "entities" in tweet and tweet["entities"]:
                 if "description" in tweet["entities"]:
                     tweet["entities"]["description"] = self._process_entities(
-                        tweet["entities"]["description"]
+                        dict(tweet["entities"]["description"])
                     )
                 if "url" in tweet["entities"]:
                     tweet["entities"]["url"] = self._process_entities(
-                        tweet["entities"]["url"]
+                        dict(tweet["entities"]["url"])
                     )
                     # User url:
                     tweet["url"] = tweet["entities"]["url"]["urls"][-1]
@@ -446,87 +647,205 @@ class DataFrameConverter:
 
         return tweet
 
-    def _process_tweets(self, tweets):
+    def _transform(self, objects):
         """
-        Count, deduplicate objects before adding them to the dataframe.
+        Generate formatted objects from a batch of parsed lines, flattening, counting and deduplicating
+        them in the same pass. (Optional) Referenced tweets are inserted as new rows before the tweet.
         """
-        for tweet in tweets:
-            if "id" in tweet:
-                tweet_id = tweet["id"]
-                self.counts["tweets"] += 1
-                if tweet_id in self.dataset_ids:
-                    self.counts["duplicates"] += 1
-                if self.allow_duplicates:
-                    yield tweet
+        # Attributes used for every tweet are looked up once per batch
+        dataset_ids = self.dataset_ids
+        format_tweet = self._format_tweet
+        inline_referenced_tweets = self.inline_referenced_tweets
+        allow_duplicates = self.allow_duplicates
+        tweets = duplicates = non_objects = referenced_tweets = unavailable = 0
+        try:
+            for o in objects:
+                # Already flattened objects are used as they are, API responses are
+                # flattened here, everything else (lists, errors, responses without
+                # includes) is left to ensure_flattened:
+                if isinstance(o, dict) and "data" in o and "includes" in o:
+                    flattened = flatten_response(o)
+                elif (
+                    isinstance(o, dict)
+                    and "data" not in o
+                    and "includes" not in o
+                    and "errors" not in o
+                ):
+                    flattened = (o,)
                 else:
-                    if tweet_id not in self.dataset_ids:
-                        yield tweet
-                self.dataset_ids.add(tweet_id)
-            elif self.input_data_type == "counts":
-                self.counts["tweets"] += 1
-                yield tweet
-            else:
-                # non tweet objects are usually streaming API errors etc.
-                self.counts["non_objects"] += 1
+                    flattened = ensure_flattened(o)
+                for tweet in flattened:
+                    if "referenced_tweets" in tweet and inline_referenced_tweets:
+                        rows = []
+                        twarc_meta = tweet["__twarc"] if "__twarc" in tweet else None
+                        for referenced_tweet in tweet["referenced_tweets"]:
+                            # extract the referenced tweet as a new row
+                            referenced_tweets += 1
+                            # inherit __twarc metadata from parent tweet
+                            referenced_tweet["__twarc"] = twarc_meta
+                            # write tweet as new row if referenced tweet exists (has more than the 3 default fields):
+                            if len(referenced_tweet) > 3:
+                                rows.append(format_tweet(referenced_tweet))
+                            else:
+                                unavailable += 1
+                        rows.append(format_tweet(tweet))
+                    else:
+                        rows = (format_tweet(tweet),)
+
+                    for row in rows:
+                        if "id" in row:
+                            row_id = id_key(row["id"])
+                            tweets += 1
+                            if row_id in dataset_ids:
+                                duplicates += 1
+                                if not allow_duplicates:
+                                    continue
+                            else:
+                                dataset_ids.add(row_id)
+                            yield row
+                        elif self.input_data_type == "counts":
+                            tweets += 1
+                            yield row
+                        else:
+                            # non tweet objects are usually streaming API errors etc.
+                            non_objects += 1
+        finally:
+            # The per row counts are added once per batch
+            self.counts["tweets"] += tweets
+            self.counts["duplicates"] += duplicates
+            self.counts["non_objects"] += non_objects
+            self.counts["referenced_tweets"] += referenced_tweets
+            self.counts["unavailable"] += unavailable
+
+    def _encode_value(self, x):
+        """
+        Escape or encode a single value. Used for columns with mixed types, eg: lists.
+        """
+        if type(x) is str:
+            # (Optional) text escape, otherwise mandatory newline escape:
+            if self.json_encode_text:
+                return json_dumps(x)
+            return escape_newlines(x)
+        # (Optional) json for lists, parsed json has no other list-likes than lists and dicts
+        if self.json_encode_lists and isinstance(x, (list, dict)):
+            return json_dumps(x)
+        return x
 
     def _process_dataframe(self, _df):
         """
         Apply additional preprocessing to the DataFrame contents.
+
+        This works column by column instead of cell by cell: only object columns
+        can contain text or lists. Encoded columns are collected and the dataframe
+        is rebuilt once, instead of replacing its columns one at a time.
+        """
+
+        columns = {}
+        changed = False
+        for col, values in _df.items():
+            columns[col] = self._process_column(col, values)
+            changed = changed or columns[col] is not values
+        # Nothing to encode, eg: counts, or batches that were skipped
+        if not changed:
+            return _df
+        return pd.DataFrame(columns, index=_df.index, columns=_df.columns)
+
+    def _process_column(self, col, values):
+        """
+        Escape or encode the values of one column, or return them unchanged.
         """
 
         # (Optional) json encode all
         if self.json_encode_all:
-            _df = _df.applymap(json.dumps, na_action="ignore")
-        else:
-            # (Optional) text escape for any text fields
+            # Integers are written the same way with or without json
+            if pd.api.types.is_integer_dtype(values.dtype):
+                return values
+            return map_values(values, json_dumps)
+
+        if values.dtype != object:
+            return values
+        if self.json_encode_lists and col in LIST_COLUMNS:
+            # (Optional) json for lists, known list columns skip the type checks
+            return map_values(values, json_dumps)
+        kind = pd.api.types.infer_dtype(values, skipna=True)
+        if kind in ("empty", "boolean", "integer", "floating"):
+            return values
+        if kind == "string":
             if self.json_encode_text:
-                _df = _df.applymap(
-                    lambda x: json.dumps(x) if type(x) is str else x,
-                    na_action="ignore",
-                )
-            else:
-                # Mandatory newline escape to prevent breaking csv format:
-                _df = _df.applymap(
-                    lambda x: x.replace("\r", "").replace("\n", r"\n")
-                    if type(x) is str
-                    else x,
-                    na_action="ignore",
-                )
-            # (Optional) json for lists
-            if self.json_encode_lists:
-                _df = _df.applymap(
-                    lambda x: json.dumps(x) if pd.api.types.is_list_like(x) else x,
-                    na_action="ignore",
-                )
-        return _df
+                # (Optional) text escape for any text fields
+                return map_values(values, json_dumps)
+            # Mandatory newline escape to prevent breaking csv format:
+            return map_values(values, escape_newlines)
+        if self.json_encode_lists:
+            # Mixed values, lists and dicts are encoded so every value is a scalar
+            return map_values(values, self._encode_value)
+        # Lists and dicts are left as they are, which can't be set with a mask
+        return values.map(self._encode_value, na_action="ignore")
+
+    def _build_dataframe(self, objects):
+        """
+        Flatten, format and deduplicate the objects into a dataframe with the input columns.
+        """
 
-    def process(self, objects):
+        tweets = list(self._transform(objects))
+        # Check for mismatched columns, all the keys are only needed to report them
+        if any(self._has_unexpected(tweet) for tweet in tweets):
+            keys = set()
+            for tweet in tweets:
+                keys.update(self._flat_keys(tweet))
+            self._check_columns(keys, len(tweets))
+            return pd.DataFrame(columns=self._columns_index)
+
+        return self._records_dataframe(tweets)
+
+    def _check_columns(self, keys, batch_length):
         """
-        Process the objects into a pandas dataframe.
+        Check the flattened keys of a batch against the input columns.
+        Returns False, after reporting the unexpected keys, if the batch has to be skipped.
         """
 
-        tweet_batch = itertools.chain.from_iterable(
-            self._process_tweets(self._inline_referenced_tweets(tweet))
-            for tweet in self._flatten_objects(objects)
-        )
-        _df = pd.json_normalize(list(tweet_batch))
-        # Check for mismatched columns
-        diff = set(_df.columns) - set(self.columns)
+        diff = keys - self._columns_set
         if len(diff) > 0:
             click.echo(
                 click.style(
                     f"💔 ERROR: {len(diff)} Unexpected items in data! \n"
                     "Are you sure you specified the correct --input-data-type?\n"
                     "If the object type is correct, add extra columns with:"
-                    f"\n--extra-input-columns \"{','.join(diff)}\"\nSkipping entire batch of {len(_df)} {self.input_data_type}!",
+                    f"\n--extra-input-columns \"{','.join(diff)}\"\nSkipping entire batch of {batch_length} {self.input_data_type}!",
                     fg="red",
                 ),
                 err=True,
             )
             log.error(
-                f"CSV Unexpected Data: \"{','.join(diff)}\". Expected {len(self.columns)} columns, got {len(_df.columns)}. Skipping entire batch of {len(_df)} {self.input_data_type}!"
+                f"CSV Unexpected Data: \"{','.join(diff)}\". Expected {len(self.columns)} columns, got {len(keys)}. Skipping entire batch of {batch_length} {self.input_data_type}!"
             )
-            self.counts["parse_errors"] += len(_df)
-            return pd.DataFrame(columns=self.columns)
+            self.counts["parse_errors"] += batch_length
+            return False
+        return True
+
+    def _records_dataframe(self, tweets):
+        """
+        Make a dataframe of the input columns from transformed objects.
+        """
+
+        # The values are extracted directly, only for the known columns:
+        rows = [self._extract(tweet) for tweet in tweets]
+        _df = pd.DataFrame.from_records(rows, columns=self._columns_index)
+
+        # Integer columns with missing values would become floats (eg: 23.0), depending on
+        # the other rows in the batch. Use nullable integers, so ints are always written as ints:
+        nullable_ints = {}
+        for position, (col, values) in enumerate(_df.items()):
+            if values.dtype.kind == "f" and values.hasnans:
+                column = [row[position] for row in rows]
+                if all(type(value) is int for value in column if value is not None):
+                    nullable_ints[col] = pd.array(column, dtype="Int64")
+        for col, values in nullable_ints.items():
+            _df[col] = values
+        return _df
 
-        return self._process_dataframe(_df.reindex(columns=self.columns))
+    def process(self, objects):
+        """
+        Process the objects into a pandas dataframe.
+        """
+        return self._process_dataframe(self._build_dataframe(objects))
@@ -19,6 +19,7 @@ setuptools.setup(
         "pandas>=1.3.5",
         "more-itertools>=8.7.0",
         "tqdm>=4.59.0",
+        "orjson>=3.6.0",
     ],
     setup_requires=["pytest-runner"],
     tests_require=["pytest"],
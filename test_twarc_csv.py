@@ -1,8 +1,15 @@
+import copy
+import csv
+import io
+import json
 import pandas
 import pathlib
 import twarc_csv
+import csv_writer
+import dataframe_converter
 
 from click.testing import CliRunner
+from twarc.expansions import flatten
 
 runner = CliRunner()
 test_data = pathlib.Path("test-data")
@@ -14,8 +21,9 @@ def _process_file(fname, expected=None, extra=""):
     if output_file.is_file():
         output_file.unlink()
 
+    # Small batches, so files with several lines are converted in more than one batch
     result = runner.invoke(
-        twarc_csv.csv, f"{str(input_file)} {str(output_file)}{extra}"
+        twarc_csv.csv, f"{str(input_file)} {str(output_file)} --batch-size 2{extra}"
     )
 
     assert output_file.is_file()
@@ -143,3 +151,206 @@ def test_verified_type():
 
 def test_missing_entities():
     _process_file("entities_test")
+
+
+def test_jobs():
+    _process_file("2sets", extra=" --jobs 2")
+
+
+def _convert(input_file, output_file, extra=""):
+    result = runner.invoke(
+        twarc_csv.csv, f"{str(input_file)} {str(output_file)} --hide-progress{extra}"
+    )
+    return result, output_file.read_bytes()
+
+
+def _convert_objects(tmp_path, objects, extra=""):
+    input_file = tmp_path / "objects.jsonl"
+    input_file.write_text("".join(json.dumps(o) + "\n" for o in objects))
+    _, output = _convert(input_file, tmp_path / "objects.csv", extra)
+    output = output.decode("utf8")
+    return output, list(csv.DictReader(output.splitlines()))
+
+
+def test_jobs_same_output(tmp_path):
+    # Duplicates across batches are dropped by the main process, including
+    # a duplicate without an author, which has missing integer metrics
+    sets = (test_data / "2sets.jsonl").read_bytes()
+    duplicate = {"id": json.loads(sets.splitlines()[0])["data"][0]["id"], "text": ""}
+    input_file = tmp_path / "duplicates.jsonl"
+    input_file.write_bytes(
+        sets
+        + json.dumps(duplicate).encode()
+        + b"\n"
+        + (test_data / "noflat.jsonl").read_bytes()
+        + sets
+    )
+    for extra in (" --batch-size 2", " --batch-size 1 --inline-referenced-tweets"):
+        _, serial = _convert(input_file, tmp_path / "serial.csv", extra)
+        result, parallel = _convert(
+            input_file, tmp_path / "parallel.csv", extra + " --jobs 2"
+        )
+        assert "were duplicates" in result.output
+        assert serial == parallel
+
+
+def test_jobs_unexpected_counts(tmp_path):
+    input_file = tmp_path / "counts.jsonl"
+    response = json.loads((test_data / "counts.jsonl").read_text())
+    response["data"][0]["unexpected"] = 1
+    input_file.write_text(json.dumps(response) + "\n")
+    extra = " --input-data-type counts --jobs 2"
+    result, output = _convert(input_file, tmp_path / "counts.csv", extra)
+    assert "Unexpected items" in result.output
+    assert len(pandas.read_csv(tmp_path / "counts.csv")) == 0
+
+
+def test_auto_batch_size(tmp_path):
+    input_file = test_data / "withheld.jsonl"
+    with open(input_file, "rb") as infile, open(tmp_path / "out.csv", "w") as outfile:
+        lines = len(infile.readlines())
+        infile.seek(0)
+        # Smaller than 2MB, so the file is one batch, or split between jobs
+        converter = csv_writer.CSVConverter(infile, outfile, hide_progress=True)
+        assert converter.batch_size >= lines
+        converter = csv_writer.CSVConverter(infile, outfile, hide_progress=True, jobs=4)
+        assert converter.batch_size < lines
+        # Seekable file objects without a file descriptor
+        infile.seek(0)
+        buffer = io.BytesIO(infile.read())
+        buffer.name = str(input_file)
+        converter = csv_writer.CSVConverter(buffer, outfile, hide_progress=True)
+        assert converter.batch_size >= lines
+
+
+def test_dataset_ids():
+    response = json.loads((test_data / "2sets.jsonl").read_text().splitlines()[0])
+    tweet_id = response["data"][0]["id"]
+    converter = dataframe_converter.DataFrameConverter(dataset_ids={tweet_id})
+    _df = converter.process([response])
+    assert tweet_id not in _df["id"].astype(str).tolist()
+    assert converter.counts["duplicates"] == 1
+
+
+def test_flatten_response():
+    # Same output as twarc's flatten, including key order, for every API response
+    responses = 0
+    for input_file in sorted(test_data.glob("*.jsonl")):
+        for line in input_file.read_text().splitlines():
+            try:
+                response = json.loads(line)
+            except ValueError:
+                continue
+            if not (
+                isinstance(response, dict)
+                and "data" in response
+                and "includes" in response
+            ):
+                continue
+            responses += 1
+            expected = json.dumps(flatten(copy.deepcopy(response)))
+            flattened = dataframe_converter.flatten_response(response)
+            assert json.dumps(flattened) == expected
+    assert responses > 0
+
+
+def test_flatten_response_missing():
+    response = {
+        "data": [
+            {
+                "id": "1",
+                "author_id": "2",
+                "withheld": None,
+                "attachments": {"media_keys": ["3_1"]},
+            }
+        ],
+        "includes": {"users": []},
+    }
+    # twarc's flatten raises a TypeError for None values, they are kept here.
+    # Missing includes are expanded to empty objects.
+    tweet = dataframe_converter.flatten_response(response)[0]
+    assert tweet["withheld"] is None
+    assert tweet["author"] == {}
+    assert tweet["attachments"]["media"] == [{}]
+
+
+def test_read_chunks(tmp_path, monkeypatch):
+    # Lines across chunk boundaries, CRLF line endings, and no newline at the end
+    monkeypatch.setattr(csv_writer, "READ_CHUNK_SIZE", 4)
+    input_file = tmp_path / "chunks.jsonl"
+    input_file.write_bytes(b'{"a": 1}\r\n\r\n{"b": "' + b"x" * 20 + b'"}\n{"c": 3}')
+    with open(input_file, "rb") as infile, open(tmp_path / "out.csv", "w") as outfile:
+        converter = csv_writer.CSVConverter(
+            infile,
+            outfile,
+            converter=dataframe_converter.DataFrameConverter(),
+            hide_progress=True,
+        )
+        lines = [line for lines in converter._read_chunks() for line in lines]
+        assert lines == [
+            b'{"a": 1}\r',
+            b"\r",
+            b'{"b": "' + b"x" * 20 + b'"}',
+            b'{"c": 3}',
+        ]
+        assert converter.converter.counts["lines"] == 4
+        infile.seek(0)
+        assert list(converter._read_lines()) == [{"a": 1}, {"b": "x" * 20}, {"c": 3}]
+        assert converter.converter.counts["parse_errors"] == 0
+
+
+def test_escape_newlines(tmp_path):
+    tweet = {"id": "1", "text": "a\r\nb"}
+    # Text column, and mixed column (text and numbers)
+    for objects in ([tweet], [tweet, {"id": "2", "text": 5}]):
+        output, rows = _convert_objects(tmp_path, objects)
+        assert "\r" not in output
+        assert len(output.splitlines()) == len(objects) + 1
+        assert rows[0]["text"] == r"a\nb"
+
+
+def test_json_encode_format(tmp_path):
+    tweet = {
+        "id": "1",
+        "text": "café\r\nline",
+        "possibly_sensitive": False,
+        "score": 1.5,
+        "entities": {
+            "hashtags": [
+                {"start": 0, "end": 2, "tag": "a"},
+                {"start": 3, "end": 5, "tag": "b"},
+            ]
+        },
+    }
+    extra = " --extra-input-columns score"
+    _, rows = _convert_objects(tmp_path, [tweet], extra)
+    assert rows[0]["entities.hashtags"] == '["#a","#b"]'
+    assert rows[0]["possibly_sensitive"] == "False"
+    assert rows[0]["score"] == "1.5"
+    # Non-ASCII text is not escaped:
+    _, rows = _convert_objects(tmp_path, [tweet], extra + " --json-encode-text")
+    assert rows[0]["text"] == '"café\\r\\nline"'
+    assert rows[0]["entities.hashtags"] == '["#a","#b"]'
+    _, rows = _convert_objects(tmp_path, [tweet], extra + " --json-encode-all")
+    assert rows[0]["possibly_sensitive"] == "false"
+    assert rows[0]["score"] == "1.5"
+    assert rows[0]["id"] == '"1"'
+
+
+def test_json_encode_lists(tmp_path):
+    tweet = {"id": "1", "text": "", "entities": {"hashtags": [{"tag": "a"}]}}
+    assert "entities.hashtags" in dataframe_converter.LIST_COLUMNS
+    _, rows = _convert_objects(tmp_path, [tweet], " --json-encode-lists")
+    assert rows[0]["entities.hashtags"] == '["#a"]'
+    _, rows = _convert_objects(tmp_path, [tweet], " --no-json-encode-lists")
+    assert rows[0]["entities.hashtags"] == "['#a']"
+
+
+def test_parse_lines():
+    counts = {"parse_errors": 0}
+    lines = [b'{"a": 1}', b'{"a": NaN, "b": Infinity}', b"", b'{"a": ']
+    objects = list(csv_writer.parse_lines(lines, counts))
+    assert objects[0] == {"a": 1}
+    assert objects[1]["b"] == float("inf")
+    assert len(objects) == 2
+    assert counts["parse_errors"] == 1
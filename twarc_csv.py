@@ -28,17 +28,19 @@ def _validate_output_columns(context, parameter, value):
             "compliance": dataframe_converter.DEFAULT_COMPLIANCE_COLUMNS,
             "lists": dataframe_converter.DEFAULT_LISTS_COLUMNS,
         }
+        columns = valid[input_data_type]
+        valid_columns = set(columns)
         for v in values:
-            if v not in valid[input_data_type]:
+            if v not in valid_columns:
                 raise click.BadOptionUsage(
                     parameter.name,
-                    f'"{v}" is not a valid entry for --{parameter.name}. Must be a comma separated string, without spaces, valid entries: {",".join(valid[input_data_type])}',
+                    f'"{v}" is not a valid entry for --{parameter.name}. Must be a comma separated string, without spaces, valid entries: {",".join(columns)}',
                 )
         return ",".join(values)
 
 
 @click.command()
-@click.argument("infile", type=click.File("r", encoding="utf8"), default="-")
+@click.argument("infile", type=click.File("rb"), default="-")
 @click.argument("outfile", type=click.File("w", encoding="utf8"), default="-")
 @click.option(
     "--input-data-type",
@@ -100,8 +102,14 @@ def _validate_output_columns(context, parameter, value):
 @click.option(
     "--batch-size",
     type=int,
-    default=100,
-    help="How many lines to process per chunk. Default is 100. Reduce this if output is slow.",
+    default=None,
+    help="How many lines to process per chunk. Default is about 2MB of input for files, or 100 for pipes. Reduce this if output is slow.",
+)
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="How many processes to use for converting batches in parallel. Default is 1.",
 )
 @click.option(
     "--hide-stats",
@@ -129,6 +137,7 @@ def csv(
     extra_input_columns,
     output_columns,
     batch_size,
+    jobs,
     hide_stats,
     hide_progress,
 ):
@@ -179,6 +188,7 @@ def csv(
         output_format="csv",
         batch_size=batch_size,
         hide_progress=hide_progress,
+        jobs=jobs,
     )
     writer.process()
 